@@ -1,8 +1,9 @@
-#! /usr/bin/env python
+#! /usr/bin/env python3
 # wget-mp.py
 
 # == Description ============================================================
-# A simple python script for parallel file fitching using wget.
+# A simple python script for parallel file fitching using wget (or in-process
+# using requests / aiohttp).
 
 # == License ================================================================
 # Copyright (c) 2010, cbaoth
@@ -17,15 +18,50 @@
 #   documentation and/or other materials provided with the distribution.
 
 # == Comments, Todo etc. ====================================================
-# ...
+# Requires python 3. Runs unchanged on pypy3 (pypy3 wget-mp.py ...), which
+# speeds up the per url handling of long url lists.
 
 import sys, os, traceback
-import string
+import itertools
+import importlib.util
+from collections import OrderedDict, Counter, deque
 import re
+import mimetypes
+import json
+from email.utils import formatdate, parsedate_to_datetime
 import time
+import signal
+import selectors
+import socket
+import threading
+import asyncio
 import subprocess
 from subprocess import Popen
-from threading import Timer
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+
+# optional: in-process downloads (connection reuse, no fork/exec per url)
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    HAVE_REQUESTS = True
+except ImportError:
+    HAVE_REQUESTS = False
+
+# optional: asynchronous downloads (single thread, many connections)
+try:
+    import aiohttp
+    HAVE_AIOHTTP = True
+except ImportError:
+    HAVE_AIOHTTP = False
+
+# optional: asynchronous downloads multiplexed over http/2 connections
+try:
+    import httpx
+    # http2=True needs the h2 package (httpx[http2]), only check it's there
+    HAVE_HTTPX = importlib.util.find_spec('h2') is not None
+except ImportError:
+    HAVE_HTTPX = False
 
 # ----------------------------------------------------------------------
 # constants
@@ -34,8 +70,26 @@ PROGNAME = "wget multi process"
 VERSION = "20120802"
 # http user agent used for identifiaction
 UAGENT = "Mozilla/5.0 (X11; U; FreeBSD i386; en-US; rv:1.4b) Gecko/20030517 Mozilla Firebird/0.6"
-# max concurrent processes
-MAXPROC = 8
+# max concurrent processes, downloads are i/o bound, so default to a few per
+# usable cpu (like ThreadPoolExecutor), can be set using WGETMP_MAXPROC
+try:
+    NCPU = len(os.sched_getaffinity(0))
+except AttributeError:
+    NCPU = os.cpu_count() or 4
+MAXPROC = min(32, 4 * NCPU)
+if ('WGETMP_MAXPROC' in os.environ):
+    try:
+        MAXPROC = int(os.environ['WGETMP_MAXPROC'])
+        if (MAXPROC < 1):
+            raise ValueError()
+    except ValueError:
+        MAXPROC = min(32, 4 * NCPU)
+        # p_err isn't defined yet
+        print("ERROR: ignoring invalid WGETMP_MAXPROC=%s, using %s"
+              % (os.environ['WGETMP_MAXPROC'], MAXPROC), file=sys.stderr)
+# max concurrent processes per host (0 = maxproc), if capped pending urls of
+# other hosts are started instead of waiting behind a busy host
+MAXPERHOST = 0
 # max runtime before process gets killed (timeout in seconds)
 PROCESSTIMEOUT = 0 # 10*60
 # debug level
@@ -47,87 +101,698 @@ DEBUG = 0
 CONNECTTIMEOUT=0  # wget default: 0, connection time
 DNSTIMEOUT=0      # wget default: 0, dns lookup time
 READTIMEOUT=900   # wget default: 900, read idle time
+# max urls per wget process (same host urls only, keep-alive is reused)
+WGETBATCH = 50
+# download backend, wget (one process per url), requests (threads sharing one
+# http session), aiohttp (coroutines on a single thread) or httpx (same, but
+# using http/2 where supported, many requests share one connection)
+BACKENDS = ['wget', 'requests', 'aiohttp', 'httpx']
+BACKEND = 'aiohttp' if HAVE_AIOHTTP else 'requests' if HAVE_REQUESTS else 'wget'
+# read size per chunk (in-process backends)
+CHUNKSIZE = 1 << 16
+# state of completed downloads (etag, size) used for conditional requests
+# (-N, in-process backends), stored in the current directory
+STATEFILE = ".wgetmp-state"
+# chunks collected before writing them to disk with a single writev call
+WRITEBATCH = 16
+HAVE_WRITEV = hasattr(os, 'writev')
+# content types not worth (re)compressing on the wire (prefix match)
+INCOMPRESSIBLE = ('image/', 'audio/', 'video/', 'font/woff', 'application/zip',
+                  'application/x-7z-compressed', 'application/x-rar-compressed',
+                  'application/x-xz', 'application/vnd.rar')
 
 # ----------------------------------------------------------------------
 # print stuff
 # ----------------------------------------------------------------------
-def p_dbg(msg, level=1):
+def p_dbg(fmt, *args, level=1):
+    # formatting is deferred until the level is known to be enabled
     if (DEBUG >= level):
-        print "* DBG-%s: %s" % (level, msg)
+        print("* DBG-%s: %s" % (level, fmt % args if args else fmt))
 
 def p_msg(msg):
-    print "> %s" % (msg)
+    print("> %s" % (msg))
 
 def p_err(msg):
-    print >> sys.stderr, "ERROR: %s" % (msg)
+    print("ERROR: %s" % (msg), file=sys.stderr)
 
 # ----------------------------------------------------------------------
 # add simple timer to Popen class
 # ----------------------------------------------------------------------
 def start_timer(self):
-    self.start_time = time.mktime(time.gmtime())
+    self.start_time = time.monotonic()
 Popen.start_timer = start_timer
 def get_runtime(self):
-    return time.mktime(time.gmtime()) - self.start_time
+    return time.monotonic() - self.start_time
 Popen.get_runtime = get_runtime
 
 # ----------------------------------------------------------------------
 # process handling
 # ----------------------------------------------------------------------
+class HostQueue:
+    """Pending jobs per host, handed out round-robin (one host after another)
+    while keeping at most max_per_host jobs of a host in flight."""
+
+    def __init__(self, max_per_host=0):
+        self.queues = OrderedDict()  # host -> deque of jobs
+        self.inflight = Counter()    # host -> running jobs
+        self.max_per_host = max_per_host
+        self.pending = 0
+
+    def __len__(self):
+        return self.pending
+
+    def put(self, host, job):
+        self.queues.setdefault(host, deque()).append(job)
+        self.pending += 1
+
+    def get(self):
+        # next (host, job) that may be started, None if there is none
+        for host, queue in self.queues.items():
+            if (self.max_per_host > 0 and self.inflight[host] >= self.max_per_host):
+                continue
+            job = queue.popleft()
+            if (len(queue) > 0):
+                self.queues.move_to_end(host)
+            else:
+                del self.queues[host]
+            self.pending -= 1
+            self.inflight[host] += 1
+            return host, job
+        return None
+
+    def done(self, host):
+        self.inflight[host] -= 1
+        if (self.inflight[host] <= 0):
+            del self.inflight[host]
+
+    def clear(self):
+        self.queues.clear()
+        self.pending = 0
+
+
 class ProcessPool:
+    # wget reports one status for all urls it was given, so failures are
+    # counted per process
+    failmsg = "%s wget process(es) failed"
 
-    def __init__(self, process_timeout=PROCESSTIMEOUT, max_processes=MAXPROC):
-        self.proc = []
+    def __init__(self, process_timeout=PROCESSTIMEOUT, max_processes=MAXPROC,
+                 max_per_host=MAXPERHOST):
+        self.procs = {}  # pid -> Popen (running processes)
+        self.queue = HostQueue(max_per_host)
+        self.max_queued = max_processes * 2
+        self.killed = set()  # pids killed but not yet reaped
+        self.failed = 0  # processes that didn't exit successfully
         self.process_timeout = process_timeout
         self.max_processes = max_processes
-        #self.clean_lock = threading.RLock()
-
-    def __clean(self):
-        newproc = []
-        for p in self.proc:
-            if (p.poll() == None):
-                if (self.process_timeout > 0 and p.get_runtime() > self.process_timeout):
-                    p_msg("process %s killed, exceeded max runtime (%s sec)" % (p.pid, self.process_timeout))
-                    p.kill()
-                else:
-                    p_dbg("process %s running since %s sec" % (p.pid, p.get_runtime()), 2)
-                    newproc.append(p)
-            else:
-                p_dbg("process %s finished" % (p.pid), 3)
-        self.proc = newproc
+        # self-pipe, signal.set_wakeup_fd writes to it on every SIGCHLD so
+        # waiting on the selector returns as soon as a child exits
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        # a python level handler is needed for the wakeup fd to be written,
+        # the actual reaping is done in __wait (not within the handler)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(self.wakeup_w)
+        self.reporter = None
+        # shared by all processes instead of one open() per spawn, stderr is
+        # inherited to keep wget's error messages
+        self.devnull = open(os.devnull, 'wb')
+
+    def __reap(self):
+        # reap all terminated children (non-blocking), drain the wakeup pipe
+        # first so it can't fill up
+        try:
+            while (os.read(self.wakeup_r, 512)):
+                pass
+        except BlockingIOError:
+            pass
+        while (len(self.procs) > 0):
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if (pid == 0):
+                break
+            self.__reaped(pid, status)
+
+    def __reaped(self, pid, status):
+        p = self.procs.get(pid)
+        if (p is not None):
+            p.returncode = os.waitstatus_to_exitcode(status)
+            self.__finished(p)
+
+    def __finished(self, p):
+        self.procs.pop(p.pid, None)
+        self.killed.discard(p.pid)
+        self.queue.done(p.host)
+        if (p.returncode != 0):
+            self.failed += 1
+            p_err("wget exited with status %s: %s" % (p.returncode, ' '.join(p.urls)))
+        else:
+            p_dbg("process %s finished", p.pid, level=3)
+
+    def __wait(self, timeout=None):
+        # block until a child exits or the timeout (sec, None = forever) is up
+        if (timeout is None and len(self.procs) > 0):
+            # nothing can expire, simply wait for any child to exit
+            try:
+                pid, status = os.waitpid(-1, 0)
+                self.__reaped(pid, status)
+            except ChildProcessError:
+                pass
+        else:
+            self.selector.select(timeout)
+        self.__reap()
+
+    def __next_timeout(self, deadline=None):
+        # time left until the next process exceeds its max runtime (or the
+        # given deadline is reached), None if there is nothing to wait for
+        timeouts = []
+        if (deadline is not None):
+            timeouts.append(deadline - time.monotonic())
+        if (self.process_timeout > 0):
+            timeouts += [self.process_timeout - p.get_runtime() for p in self.procs.values()
+                         if p.pid not in self.killed]
+        return max(0, min(timeouts)) if timeouts else None
+
+    def __kill(self, p):
+        p.kill()
+        if (p.returncode is not None):
+            # reaped by Popen itself (kill polls first)
+            self.__finished(p)
+        else:
+            self.killed.add(p.pid)
+
+    def __kill_expired(self):
+        if (self.process_timeout <= 0):
+            return
+        for p in list(self.procs.values()):
+            if (p.pid not in self.killed and p.get_runtime() >= self.process_timeout):
+                p_msg("process %s killed, exceeded max runtime (%s sec)" % (p.pid, self.process_timeout))
+                self.__kill(p)
 
     def killall(self):
         p_dbg("it's killing time ...")
-        for p in self.proc:
-            if (p.poll() == None):
+        self.queue.clear()
+        for p in list(self.procs.values()):
+            if (p.pid not in self.killed):
                 p_msg("process %s killed (killall called)" % (p.pid))
-                p.kill()
-
-    def run(self, cmd):
-        while (len(self.proc) >= self.max_processes):
-            self.__clean()
-            time.sleep(1)
-            #Timer(1, self.__clean).start()
-        p_dbg("spawning new process: " + str(cmd), 2)
-        p = subprocess.Popen(cmd, stdout=None)
+                self.__kill(p)
+
+    def __spawn(self, host, cmd, urls):
+        p_dbg("spawning new process: %r + %r", cmd, urls, level=2)
+        p = subprocess.Popen((*cmd, *urls), stdout=self.devnull)
+        p.urls = urls
+        p.host = host
         p.start_timer()
-        p_dbg("new process: " + str(p.pid), 3)
-        self.proc.append(p)
+        p_dbg("new process: %s", p.pid, level=3)
+        self.procs[p.pid] = p
+
+    def __dispatch(self):
+        # start queued jobs while there are free slots
+        while (len(self.procs) < self.max_processes):
+            job = self.queue.get()
+            if (job is None):
+                break
+            host, (cmd, urls) = job
+            self.__spawn(host, cmd, urls)
+
+    def __step(self, deadline=None):
+        self.__wait(self.__next_timeout(deadline))
+        self.__kill_expired()
+        self.__dispatch()
+
+    def run(self, cmd, urls, host=""):
+        self.__reap()
+        self.queue.put(host, (cmd, urls))
+        self.__dispatch()
+        # don't queue up more than a few jobs ahead of the running ones
+        while (len(self.queue) + len(self.procs) >= self.max_queued):
+            self.__step()
+
+    def __report(self, stime, interval=10):
+        # progress message, printed by a timer thread independent of reaping
+        p_msg("waiting for %s processes to finish (runtime: %1.0fs) .."
+              % (len(self.procs) + len(self.queue), time.monotonic() - stime))
+        self.reporter = threading.Timer(interval, self.__report, [stime, interval])
+        self.reporter.daemon = True
+        self.reporter.start()
+
+    def finalize(self, timeout=0, verbose=1):
+        p_dbg("finalizing")
+        stime = time.monotonic()
+        deadline = stime + timeout if timeout > 0 else None
+        self.__reap()
+        self.__dispatch()
+        if (verbose > 0 and len(self.procs) > 0):
+            self.__report(stime)
+        try:
+            while (len(self.procs) > 0):
+                if (deadline is not None and time.monotonic() >= deadline):
+                    self.killall()
+                    deadline = None
+                self.__step(deadline)
+        finally:
+            if (self.reporter is not None):
+                self.reporter.cancel()
+            self.devnull.close()
+
+
+class ChunkWriter:
+    """Collects downloaded chunks and writes them to an unbuffered file with
+    one writev() syscall per batch instead of one write() per chunk."""
+
+    def __init__(self, f, batch=WRITEBATCH):
+        self.f = f
+        self.batch = batch
+        self.chunks = []
+
+    def add(self, chunk):
+        # returns True if the batch is full and should be flushed
+        self.chunks.append(chunk)
+        return len(self.chunks) >= self.batch
+
+    def flush(self):
+        chunks = self.chunks
+        self.chunks = []
+        if (not HAVE_WRITEV):
+            self.f.write(b''.join(chunks))
+            return
+        while (len(chunks) > 0):
+            written = os.writev(self.f.fileno(), chunks)
+            # partial write, drop what's done and retry with the rest
+            while (len(chunks) > 0 and written >= len(chunks[0])):
+                written -= len(chunks[0])
+                chunks.pop(0)
+            if (written > 0):
+                chunks[0] = chunks[0][written:]
+
+
+class DownloadPool:
+    """Bookkeeping shared by the in-process backends; subclasses implement
+    submit(url, target), returning a concurrent.futures.Future, and close()."""
+    failmsg = "%s url(s) failed"
+
+    def __init__(self, max_processes=MAXPROC, max_per_host=MAXPERHOST, nocontinue=False,
+                 timestamping=False):
+        self.futures = {}  # future -> (url, host) (running)
+        self.queue = HostQueue(max_per_host)
+        self.max_processes = max_processes
+        self.max_queued = max_processes * 2
+        # guards futures and queue, done callbacks run in other threads
+        self.lock = threading.Condition()
+        self.failed = 0
+        self.nocontinue = nocontinue
+        self.timestamping = timestamping
+        self.state = self.load_state() if timestamping else {}
+
+    def load_state(self):
+        if (not os.path.isfile(STATEFILE)):
+            return {}
+        try:
+            with open(STATEFILE) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            p_err("ignoring unreadable %s: %s" % (STATEFILE, e))
+            return {}
+
+    def save_state(self):
+        if (not self.timestamping):
+            return
+        with open(STATEFILE + ".tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(STATEFILE + ".tmp", STATEFILE)
+
+    def resume_from(self, target):
+        # offset to continue an existing download from (0 = fetch all)
+        if (not self.nocontinue and not self.timestamping and os.path.isfile(target)):
+            return os.path.getsize(target)
+        return 0
+
+    def request_headers(self, url, target, size):
+        # the session's default accept-encoding (gzip, deflate and br if
+        # available) is kept unless compression is pointless or would break
+        # byte ranges, which refer to the encoded content
+        headers = {}
+        if (size > 0):
+            headers['Range'] = 'bytes=%s-' % (size)
+        if (size > 0 or not compressible(url)):
+            headers['Accept-Encoding'] = 'identity'
+        # conditional request, only if the file is known to be complete
+        # (a partial file would otherwise look up to date)
+        known = self.state.get(target)
+        if (self.timestamping and known is not None and os.path.isfile(target)
+                and os.path.getsize(target) == known['size']):
+            headers['If-Modified-Since'] = formatdate(os.path.getmtime(target), usegmt=True)
+            if (known.get('etag')):
+                headers['If-None-Match'] = known['etag']
+        return headers
+
+    def completed(self, target, headers):
+        # remember a finished download, mtime is set to the server's (like wget -N)
+        if (not self.timestamping):
+            return
+        if (headers.get('Last-Modified')):
+            try:
+                mtime = parsedate_to_datetime(headers['Last-Modified']).timestamp()
+                os.utime(target, (mtime, mtime))
+            except (TypeError, ValueError):
+                pass
+        self.state[target] = {'etag': headers.get('ETag'), 'size': os.path.getsize(target)}
+
+    def killall(self):
+        p_dbg("it's killing time ...")
+        with self.lock:
+            self.queue.clear()
+            for f in list(self.futures):
+                f.cancel()
+        self.save_state()
+        self.close()
+
+    def __dispatch(self):
+        # start queued downloads while there are free slots (lock held)
+        while (len(self.futures) < self.max_processes):
+            job = self.queue.get()
+            if (job is None):
+                break
+            host, (url, target) = job
+            f = self.submit(url, target)
+            self.futures[f] = (url, host)
+            f.add_done_callback(self.__done)
+
+    def __done(self, f):
+        with self.lock:
+            url, host = self.futures.pop(f)
+            self.queue.done(host)
+            if (not f.cancelled() and f.exception() is not None):
+                self.failed += 1
+                # some exceptions (e.g. asyncio.TimeoutError) have no message
+                e = f.exception()
+                p_err("%s: %s" % (url, str(e) or type(e).__name__))
+            self.__dispatch()
+            self.lock.notify_all()
+
+    def run(self, url, target, host=""):
+        p_dbg("queueing download: %s -> %s", url, target, level=2)
+        with self.lock:
+            self.queue.put(host, (url, target))
+            self.__dispatch()
+            # don't queue up more than a few urls ahead of the running downloads
+            while (len(self.queue) + len(self.futures) >= self.max_queued):
+                self.lock.wait()
 
     def finalize(self, timeout=0, verbose=1):
         p_dbg("finalizing")
-        stime = time.mktime(time.gmtime())
-        self.__clean()
-        idx = 0
-        while (len(self.proc) > 0):
-            dtime = time.mktime(time.gmtime()) - stime
-            if (timeout > 0 and dtime >= timeout):
-                self.killall()
-            if (verbose > 0 and idx % 10 == 0):
-                p_msg("waiting for %s processes to finish (runtime: %1.0fs) .." % (len(self.proc), dtime))
-            self.__clean()
-            idx = idx + 1
-            time.sleep(1)
+        deadline = time.monotonic() + timeout if timeout > 0 else None
+        try:
+            with self.lock:
+                if (verbose > 0 and len(self.futures) > 0):
+                    p_msg("waiting for %s downloads to finish .."
+                          % (len(self.futures) + len(self.queue)))
+                while (len(self.futures) + len(self.queue) > 0):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if (remaining is not None and remaining <= 0):
+                        self.killall()
+                        break
+                    self.lock.wait(remaining)
+        finally:
+            self.save_state()
+            self.close()
+
+
+class SessionPool(DownloadPool):
+
+    def __init__(self, process_timeout=PROCESSTIMEOUT, max_processes=MAXPROC,
+                 timeout=(None, READTIMEOUT), referer=None, nocontinue=False,
+                 timestamping=False, max_per_host=MAXPERHOST):
+        super().__init__(max_processes, max_per_host, nocontinue, timestamping)
+        self.process_timeout = process_timeout
+        self.timeout = timeout
+        self.stop = threading.Event()
+        self.responses = set()  # responses being read (aborted by killall)
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = UAGENT
+        if (referer):
+            self.session.headers['Referer'] = referer
+        adapter = HTTPAdapter(pool_connections=max_processes, pool_maxsize=max_processes * 2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_processes)
+
+    def fetch(self, url, target):
+        size = self.resume_from(target)
+        headers = self.request_headers(url, target, size)
+        # a slow server may not send anything for a long time, so the max
+        # runtime is enforced by a watchdog aborting the response, until there
+        # is one the connect and read timeouts are capped instead
+        expired = threading.Event()
+        response = []
+        def expire():
+            expired.set()
+            for r in response:
+                self.abort(r)
+        def check():
+            if (self.stop.is_set()):
+                raise Exception("download of %s aborted" % (url))
+            if (expired.is_set()):
+                raise Exception("download of %s exceeded max runtime (%s sec)"
+                                % (url, self.process_timeout))
+        timeout = self.timeout
+        watchdog = None
+        if (self.process_timeout > 0):
+            timeout = tuple(min(t or self.process_timeout, self.process_timeout) for t in timeout)
+            watchdog = threading.Timer(self.process_timeout, expire)
+            watchdog.daemon = True
+            watchdog.start()
+        try:
+            with self.session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+                response.append(r)
+                self.responses.add(r)
+                if (self.stop.is_set() or expired.is_set()):
+                    self.abort(r)
+                try:
+                    written = self.download(target, size, r)
+                finally:
+                    self.responses.discard(r)
+        except Exception:
+            check()
+            raise
+        finally:
+            if (watchdog is not None):
+                watchdog.cancel()
+        # an aborted read may also just end early
+        check()
+        if (written):
+            self.completed(target, r.headers)
+            p_dbg("download of %s finished", url, level=3)
+
+    def download(self, target, size, r):
+        if (r.status_code == 416 and size > 0):
+            p_dbg("%s already complete", target, level=2)
+            return False
+        if (r.status_code == 304):
+            p_dbg("%s not modified", target, level=2)
+            return False
+        r.raise_for_status()
+        # server may ignore the range header and send the whole file
+        mode = 'ab' if r.status_code == 206 else 'wb'
+        with open(target, mode, buffering=0) as f:
+            writer = ChunkWriter(f)
+            try:
+                for chunk in self.chunks(r):
+                    if (self.stop.is_set()):
+                        break
+                    if (writer.add(chunk)):
+                        writer.flush()
+            finally:
+                # keep what we've got so far, it can be continued later
+                writer.flush()
+        return True
+
+    def chunks(self, r):
+        # yield what has been received instead of waiting for full chunks, so
+        # an aborted download keeps all of it (read1 needs urllib3 >= 2)
+        if (not hasattr(r.raw, 'read1')):
+            yield from r.iter_content(CHUNKSIZE)
+            return
+        while True:
+            chunk = r.raw.read1(CHUNKSIZE, decode_content=True)
+            if (not chunk):
+                return
+            yield chunk
+
+    def submit(self, url, target):
+        return self.executor.submit(self.fetch, url, target)
+
+    def abort(self, r):
+        # closing a response doesn't wake up a blocked read, shutting down its
+        # socket does
+        sock = getattr(r.raw.connection, 'sock', None)
+        if (sock is None):
+            p_dbg("can't abort download of %s, no socket", r.url)
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def killall(self):
+        self.stop.set()
+        for r in list(self.responses):
+            self.abort(r)
+        super().killall()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+class AsyncPool(DownloadPool):
+    """Runs all downloads as coroutines on a single event loop thread."""
+
+    def __init__(self, process_timeout=PROCESSTIMEOUT, max_processes=MAXPROC,
+                 timeout=(None, READTIMEOUT), referer=None, nocontinue=False,
+                 timestamping=False, max_per_host=MAXPERHOST):
+        super().__init__(max_processes, max_per_host, nocontinue, timestamping)
+        self.process_timeout = process_timeout
+        self.timeout = timeout
+        self.headers = {'User-Agent': UAGENT}
+        if (referer):
+            self.headers['Referer'] = referer
+        # disk writes are blocking, each batch is handed to a flusher thread
+        self.flusher = ThreadPoolExecutor(max_workers=max_processes)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.session = None
+        asyncio.run_coroutine_threadsafe(self.open(), self.loop).result()
+
+    async def open(self):
+        # session, connector and semaphore must be created within the loop
+        self.sem = asyncio.Semaphore(self.max_processes)
+        conn = aiohttp.TCPConnector(limit=self.max_processes,
+                                    limit_per_host=self.queue.max_per_host or self.max_processes,
+                                    ttl_dns_cache=300)
+        client_timeout = aiohttp.ClientTimeout(total=self.process_timeout or None,
+                                               sock_connect=self.timeout[0], sock_read=self.timeout[1])
+        self.session = aiohttp.ClientSession(connector=conn, headers=self.headers,
+                                             timeout=client_timeout)
+
+    async def close_session(self):
+        await self.session.close()
+
+    async def shutdown(self):
+        # cancel what's still running and let it finish (flush partial files)
+        # before the session and the loop go away
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if (self.session is not None):
+            await self.close_session()
+
+    async def write_all(self, f, chunks):
+        writer = ChunkWriter(f)
+        pending = None
+        try:
+            async for chunk in chunks:
+                if (writer.add(chunk)):
+                    pending = self.flusher.submit(writer.flush)
+                    await asyncio.wrap_future(pending)
+        finally:
+            # no await here, keep what we've got even if cancelled (the last
+            # batch may still be in the flusher), it can be continued later
+            if (pending is not None):
+                wait([pending])
+            writer.flush()
+
+    async def fetch(self, url, target):
+        try:
+            await self.download(url, target)
+        except aiohttp.ServerTimeoutError:
+            raise
+        except asyncio.TimeoutError:
+            # the session's total timeout (-pt), others are ServerTimeoutErrors
+            raise Exception("download of %s exceeded max runtime (%s sec)"
+                            % (url, self.process_timeout))
+
+    async def download(self, url, target):
+        size = self.resume_from(target)
+        headers = self.request_headers(url, target, size)
+        async with self.sem, self.session.get(url, headers=headers) as r:
+            if (r.status == 416 and size > 0):
+                p_dbg("%s already complete", target, level=2)
+                return
+            if (r.status == 304):
+                p_dbg("%s not modified", target, level=2)
+                return
+            r.raise_for_status()
+            mode = 'ab' if r.status == 206 else 'wb'
+            with open(target, mode, buffering=0) as f:
+                await self.write_all(f, r.content.iter_chunked(CHUNKSIZE))
+        self.completed(target, r.headers)
+        p_dbg("download of %s finished", url, level=3)
+
+    def submit(self, url, target):
+        return asyncio.run_coroutine_threadsafe(self.fetch(url, target), self.loop)
+
+    def close(self):
+        if (not self.loop.is_running()):
+            return
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.flusher.shutdown()
+
+
+class HttpxPool(AsyncPool):
+    """Like AsyncPool but using httpx, same host requests are multiplexed over
+    a single http/2 connection if the server supports it (https only)."""
+
+    async def open(self):
+        self.sem = asyncio.Semaphore(self.max_processes)
+        limits = httpx.Limits(max_connections=self.max_processes,
+                              max_keepalive_connections=self.max_processes)
+        timeout = httpx.Timeout(None, connect=self.timeout[0], read=self.timeout[1])
+        # unlike the other backends httpx doesn't follow redirects by default
+        self.session = httpx.AsyncClient(http2=True, limits=limits, timeout=timeout,
+                                         headers=self.headers, follow_redirects=True)
+
+    async def close_session(self):
+        await self.session.aclose()
+
+    async def fetch(self, url, target):
+        async with self.sem:
+            if (self.process_timeout > 0):
+                try:
+                    await asyncio.wait_for(self.download(url, target), self.process_timeout)
+                except asyncio.TimeoutError:
+                    raise Exception("download of %s exceeded max runtime (%s sec)"
+                                    % (url, self.process_timeout))
+            else:
+                await self.download(url, target)
+
+    async def download(self, url, target):
+        size = self.resume_from(target)
+        headers = self.request_headers(url, target, size)
+        async with self.session.stream('GET', url, headers=headers) as r:
+            if (r.status_code == 416 and size > 0):
+                p_dbg("%s already complete", target, level=2)
+                return
+            if (r.status_code == 304):
+                p_dbg("%s not modified", target, level=2)
+                return
+            r.raise_for_status()
+            mode = 'ab' if r.status_code == 206 else 'wb'
+            with open(target, mode, buffering=0) as f:
+                # no chunk size, yield what has been received (like aiohttp's
+                # iter_chunked) so an aborted download keeps all of it
+                await self.write_all(f, r.aiter_bytes())
+        self.completed(target, r.headers)
+        p_dbg("download of %s (%s) finished", url, r.http_version, level=3)
 
 
 # ----------------------------------------------------------------------
@@ -137,29 +802,83 @@ class ProcessPool:
 #    p_err(msg)
 #    sys.exit(ecode)
 
+_RE_SCHEME = re.compile(r"^(https?|ftp|file):/+")
+_RE_TRAIL_SLASH = re.compile(r"/+$")
+_RE_STRIP_DIR = re.compile(r".*/")
+_URL2FILENAME = str.maketrans({"/": "+", " ": "_"})
+
 def url2filename(url):
-    target = re.sub("^(https?|ftp|file):/+", "", url)
-    target = re.sub("/+$", "", target)
-    target = target.replace("/", "+")
-    target = target.replace(" ", "_")
-    return target
+    target = _RE_SCHEME.sub("", url)
+    target = _RE_TRAIL_SLASH.sub("", target)
+    return target.translate(_URL2FILENAME)
 
 
 def guessUrlFromFilename(filename):
-    target = re.sub(".*/", "", filename) # strip file path
-    target = re.sub("^", "http://", target) # we assume http protoclo
+    target = _RE_STRIP_DIR.sub("", filename) # strip file path
+    target = "http://" + target # we assume http protoclo
     target = target.replace("+", "/")
     return target
 
 
+def compressible(url):
+    # guess (by file extension) whether the content may shrink using gzip & co
+    mtype, encoding = mimetypes.guess_type(urlparse(url).path)
+    if (encoding is not None):
+        return False # .gz, .bz2, ...
+    return mtype is None or mtype == 'image/svg+xml' or not mtype.startswith(INCOMPRESSIBLE)
+
+
+def url2basename(url):
+    # file name wget would choose if no output file is given
+    target = os.path.basename(urlparse(url).path)
+    return target or "index.html"
+
+
+def hostkey(url):
+    # sort key grouping urls by host and port
+    u = urlparse(url)
+    try:
+        port = u.port or 0
+    except ValueError:
+        port = 0
+    return (u.hostname or "", port)
+
+
+def positive_int(value):
+    # argparse type, reports anything else as an invalid value
+    n = int(value)
+    if (n < 1):
+        raise ValueError()
+    return n
+
+
+def read_urls(f):
+    # lazily yield the urls listed in an (already opened) file, one per line
+    try:
+        for line in f:
+            line = line.strip()
+            if (line and not line.startswith("#")):
+                yield line
+    finally:
+        if (f is not sys.stdin):
+            f.close()
+
+
 def main():
     import argparse
 
     aparse = argparse.ArgumentParser(prog=BASENAME, description="%s (%s)" % (PROGNAME, VERSION))
     #aparse.add_argument('-v', '--verbosity', type=int, default=DEBUG
     #                    , help='set the debug level [%s]' % (DEBUG))
-    aparse.add_argument('-p', '--maxproc', type=int, default=MAXPROC
+    aparse.add_argument('-p', '--maxproc', type=positive_int, default=MAXPROC
                         , help='set maximum process count [%s]' % (MAXPROC))
+    aparse.add_argument('-b', '--backend', choices=BACKENDS, default=BACKEND
+                        , help='download using wget processes or in-process using'
+                             + ' requests (needs python-requests), aiohttp (needs'
+                             + ' aiohttp) or httpx (needs httpx and h2) [%s]' % (BACKEND))
+    aparse.add_argument('-ph', '--max-per-host', type=int, default=MAXPERHOST
+                        , help='set maximum process count per host, other hosts go'
+                             + ' first while a host is at its limit (0 = maxproc) [%s]' % (MAXPERHOST))
     aparse.add_argument('-pt', '--process-timeout', type=int, default=PROCESSTIMEOUT
                         , help='kill wget after x seconds [%s sec]' % (PROCESSTIMEOUT))
     aparse.add_argument('-t', '--timeout', type=int
@@ -171,6 +890,9 @@ def main():
     aparse.add_argument('-rt', '--read-timeout', type=int, default=READTIMEOUT
                         , help='set wget read-timeout [%s sec]' % (READTIMEOUT))
     aparse.add_argument('-r', '--referer', help='referer url')
+    aparse.add_argument('-z', '--compression', action='store_true', default=False
+                        , help='wget backend: request compressed (gzip) transfers'
+                             + ' (needs wget >= 1.19.2, always on for the other backends)')
     aparse.add_argument('-d', '--dynname', action='store_true', default=DYNNAME \
                         , help="dynamically name output file, example:"
                              + " http://foo.bar/bla/baz.tar => foo.bar+bla+baz.tar")
@@ -183,36 +905,95 @@ def main():
     aparse.add_argument('-nc', '--nocontinue', action='store_true', default=False \
                         , help="if file already exists, don\'t try to continue"
                              + " (default) but refetch and overwrite")
+    aparse.add_argument('-N', '--timestamping', action='store_true', default=False
+                        , help="don't continue existing files but only refetch them if"
+                             + " changed on the server (conditional request), with"
+                             + " --dynname/--refetch not available for the wget backend")
+
+    # opened by argparse, a bad path is reported before anything is queued
+    aparse.add_argument('-i', '--input-file', type=argparse.FileType('r')
+                        , help="read urls from file (- = stdin), one per line, lines"
+                             + " starting with # are ignored")
 
-    aparse.add_argument('url', nargs='+', help='url to fetch')
+    aparse.add_argument('url', nargs='*', help='url to fetch')
     args = aparse.parse_args() #sys.argv[1:]
 
     def usage(ecode=0):
-        print aparse.print_help()
+        aparse.print_help()
         sys.exit(ecode)
 
     if len(sys.argv) <= 1:
         usage(2)
+    if (len(args.url) == 0 and not args.input_file):
+        aparse.error("no url given")
+    if (args.timestamping and args.backend == 'wget' and (args.dynname or args.refetch)):
+        # wget ignores --timestamping for files named with -O
+        aparse.error("-N can't be combined with --dynname/--refetch using the wget"
+                     + " backend, use another backend (-b)")
+
+    if (args.backend == 'requests' and not HAVE_REQUESTS):
+        p_err("backend requests not available, python-requests required")
+        sys.exit(2)
+    if (args.backend == 'aiohttp' and not HAVE_AIOHTTP):
+        p_err("backend aiohttp not available, aiohttp required")
+        sys.exit(2)
+    if (args.backend == 'httpx' and not HAVE_HTTPX):
+        p_err("backend httpx not available, httpx and h2 required")
+        sys.exit(2)
 
     ppool = None
     try:
         # time.sleep(20)
-        ppool = ProcessPool(process_timeout=args.process_timeout, max_processes=args.maxproc)
+        if (args.backend != 'wget'):
+            if (args.timeout):
+                timeout = (args.timeout, args.timeout)
+            else:
+                # there's no separate dns timeout, it's part of connecting
+                timeout = (args.connect_timeout or None, args.read_timeout or None)
+            pool = {'requests': SessionPool, 'aiohttp': AsyncPool, 'httpx': HttpxPool}[args.backend]
+            ppool = pool(process_timeout=args.process_timeout, max_processes=args.maxproc,
+                         timeout=timeout, referer=args.referer, nocontinue=args.nocontinue,
+                         timestamping=args.timestamping, max_per_host=args.max_per_host)
+        else:
+            ppool = ProcessPool(process_timeout=args.process_timeout, max_processes=args.maxproc,
+                                max_per_host=args.max_per_host)
 
         cmd_base = ['wget', '--quiet', '-U', UAGENT]
-        if (not args.nocontinue):
-            cmd_base = cmd_base + ['-c']
+        if (args.timestamping):
+            cmd_base.append('--timestamping')
+        elif (not args.nocontinue):
+            cmd_base.append('-c')
         if (args.referer):
-            cmd_base = cmd_base + ['--referer', args.referer]
+            cmd_base += ['--referer', args.referer]
+        if (args.compression):
+            cmd_base.append('--compression=auto')
         if (args.timeout):
-            cmd_base = cmd_base + ['--timeout', str(args.timeout)]
+            cmd_base += ['--timeout', str(args.timeout)]
         else:
-            cmd_base = cmd_base + ['--connect-timeout', str(args.connect_timeout), \
+            cmd_base += ['--connect-timeout', str(args.connect_timeout), \
                 '--dns-timeout', str(args.dns_timeout), \
                 '--read-timeout', str(args.read_timeout)]
-        p_dbg("urls: %s" % ' '.join(args.url))
-        for url in args.url:
+        # shared by all urls, only extended (copied) if -O is needed
+        cmd_base = tuple(cmd_base)
+        # group urls by host (sort is stable, order per host is kept) so
+        # consecutive downloads can reuse the pooled connections
+        urls = sorted(args.url, key=lambda u: hostkey(guessUrlFromFilename(u) if args.refetch else u))
+        p_dbg("urls: %r", urls)
+        # wget backend: unless output files are named (-O) same host urls
+        # are passed to a single wget process, split in batches so there's
+        # still something to do for all processes. not with -pt (the timeout
+        # would kill the whole batch) or -i (a batch would wait for urls that
+        # are still to be read while processes are idle)
+        batches = {}  # hostkey -> urls
+        batchsize = 1
+        if (args.process_timeout <= 0 and not args.input_file):
+            batchsize = max(1, min(WGETBATCH, len(urls) // args.maxproc))
+        if (args.input_file):
+            # streamed as read (not sorted), only the urls in flight are kept
+            urls = itertools.chain(urls, read_urls(args.input_file))
+        for url in urls:
             cmd = cmd_base
+            target = None
             p_msg('URL: %s' % (url))
             if (args.refetch):
                 target = url
@@ -222,28 +1003,44 @@ def main():
                 #   continue
                 url = guessUrlFromFilename(url)
                 p_msg('  <= ASSUMED URL: %s' % (url))
-                cmd = cmd + ['-O', target]
+                cmd = (*cmd_base, '-O', target)
             elif (args.dynname):
                 target = url2filename(url)
                 if (args.skipifexists and os.path.isfile(target)):
                     p_msg('  => SKIPPING (target exists)')
                     continue
                 p_msg('  => %s' % (target))
-                cmd = cmd + ['-O', target]
-            p_dbg("executing: %s" % ' '.join(cmd))
-            ppool.run(cmd + [url])
+                cmd = (*cmd_base, '-O', target)
+            if (args.backend != 'wget'):
+                ppool.run(url, target or url2basename(url), hostkey(url))
+            elif (target is None and batchsize > 1):
+                batch = batches.setdefault(hostkey(url), [])
+                batch.append(url)
+                if (len(batch) >= batchsize):
+                    del batches[hostkey(url)]
+                    p_dbg("executing: %r + %r", cmd, batch)
+                    ppool.run(cmd, batch, hostkey(url))
+            else:
+                p_dbg("executing: %r", cmd)
+                ppool.run(cmd, (url,), hostkey(url))
+        for host, batch in batches.items():
+            p_dbg("executing: %r + %r", cmd_base, batch)
+            ppool.run(cmd_base, batch, host)
         ppool.finalize()
+        if (ppool.failed > 0):
+            p_err(ppool.failmsg % (ppool.failed))
+            sys.exit(1)
         p_msg("download(s) finished")
     except KeyboardInterrupt as e:
         p_msg('keyboard interrupt!')
-        if (ppool != None):
+        if (ppool is not None):
             p_msg('%s: killing all processes!' % (PROGNAME))
             ppool.killall()
         sys.exit(1)
     #except SystemExit as e:
     #    pass
     except Exception as e:
-        if (ppool != None):
+        if (ppool is not None):
             p_msg('%s: killing all processes!' % (PROGNAME))
             ppool.killall()
         #print sys.exc_type, sys.exc_value